@@ -8,8 +8,9 @@ https://arxiv.org/abs/2303.16199
 Port for LitGPT
 """
 
+import math
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
@@ -89,6 +90,15 @@ class GPT(BaseModel):
         if isinstance(module, CausalSelfAttention):
             module.reset_parameters()
 
+    @torch.no_grad()
+    def prepare_adapter_cache(self) -> None:
+        """Precomputes the adaption prompt keys and values of every adapter layer for inference.
+
+        Otherwise, they are computed by the first forward pass without gradients. Call it after loading the weights.
+        """
+        for block in self.transformer.h[self.config.adapter_start_layer :]:
+            block.attn.adapter_kv()
+
 
 class Block(BaseBlock):
     """The implementation is identical to `litgpt.model.Block` with the exception that
@@ -130,6 +140,7 @@ class CausalSelfAttention(BaseCausalSelfAttention):
             self.gating_factor = torch.nn.Parameter(torch.zeros(1, 1, config.n_head, 1))
             # kv cache for inference
             self.adapter_kv_cache: Optional[Tuple[torch.Tensor, torch.Tensor]] = None
+            self.adapter_kv_cache_key: Optional[Tuple] = None
         self.block_idx = block_idx
         self.apply_sliding_window_attention = (
                 config.sliding_window_size is not None and
@@ -145,29 +156,54 @@ class CausalSelfAttention(BaseCausalSelfAttention):
             return y
 
         aT = self.config.adapter_prompt_length
-        if self.adapter_kv_cache is not None:
-            # since this uses the wte weights as the prefix and the kv cache is only used during inference, ak and av
-            # are the same every call
-            ak, av = self.adapter_kv_cache
+        ak, av = self.adapter_kv()
+
+        if self.config.attention_logit_softcapping is not None:
+            T = q.size(2)
+            amask = torch.ones(T, aT, dtype=torch.bool, device=q.device)
+            ay = super().scaled_dot_product_attention(q, ak, av, amask)
         else:
-            prefix = self.adapter_wte.weight.reshape(1, aT, self.config.n_embd)
-            aqkv = self.qkv(prefix)
-            q_per_kv = self.config.n_head // self.config.n_query_groups
-            aqkv = aqkv.view(1, aT, self.config.n_query_groups, q_per_kv + 2, self.config.head_size)
-            aqkv = aqkv.permute(0, 2, 3, 1, 4)
-            _, ak, av = aqkv.split((q_per_kv, 1, 1), dim=2)
-            if self.config.n_query_groups != 1:
-                # for MHA this is a no-op
-                ak = ak.repeat_interleave(q_per_kv, dim=2)
-                av = av.repeat_interleave(q_per_kv, dim=2)
-            ak = ak.view(1, -1, aT, self.config.head_size)  # (1, nh_ak, aT, hs)
-            av = av.view(1, -1, aT, self.config.head_size)  # (1, nh_av, aT, hs)
-            self.adapter_kv_cache = (ak, av)
-
-        T = q.size(2)
-        amask = torch.ones(T, aT, dtype=torch.bool, device=q.device)
-        ay = super().scaled_dot_product_attention(q, ak, av, amask)
-        return y + self.gating_factor * ay
+            # every query attends to the whole prefix, so no mask is needed (passing one would disable the flash
+            # and memory-efficient kernels). expanding is a zero-copy view that matches the query's batch and heads
+            B, nh, _, hs = q.shape
+            scale = 1.0 / math.sqrt(self.config.attention_scores_scalar or self.config.head_size)
+            ay = torch.nn.functional.scaled_dot_product_attention(
+                q, ak.expand(B, nh, aT, hs), av.expand(B, nh, aT, hs), dropout_p=0.0, scale=scale
+            ).transpose(1, 2)
+        # same as `y + gating_factor * ay` in a single kernel, without materializing the gated prompt output
+        return torch.addcmul(y, self.gating_factor, ay)
+
+    def adapter_kv(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Returns the keys and values of the adaption prompt, of shape (1, nh_ak, aT, hs).
+
+        They only depend on the weights, so they are cached in `adapter_kv_cache` when no gradients are needed and
+        reused until the weights are replaced or updated in-place.
+        """
+        if torch.is_grad_enabled() or torch._dynamo.is_compiling():
+            # a cached result would be detached from the graph of the current step. when compiling, the validity check
+            # is not traceable, and the projection of the prompt is fused into the graph anyway
+            return self._adapter_kv()
+        key = _version_key((self.adapter_wte.weight, *self.qkv.parameters()))
+        if self.adapter_kv_cache is None or self.adapter_kv_cache_key != key:
+            self.adapter_kv_cache = self._adapter_kv()
+            self.adapter_kv_cache_key = key
+        return self.adapter_kv_cache
+
+    def _adapter_kv(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        aT = self.config.adapter_prompt_length
+        prefix = self.adapter_wte.weight.reshape(1, aT, self.config.n_embd)
+        aqkv = self.qkv(prefix)
+        q_per_kv = self.config.n_head // self.config.n_query_groups
+        aqkv = aqkv.view(1, aT, self.config.n_query_groups, q_per_kv + 2, self.config.head_size)
+        aqkv = aqkv.permute(0, 2, 3, 1, 4)
+        _, ak, av = aqkv.split((q_per_kv, 1, 1), dim=2)
+        if self.config.n_query_groups != 1:
+            # for MHA this is a no-op
+            ak = ak.repeat_interleave(q_per_kv, dim=2)
+            av = av.repeat_interleave(q_per_kv, dim=2)
+        ak = ak.view(1, -1, aT, self.config.head_size)  # (1, nh_ak, aT, hs)
+        av = av.view(1, -1, aT, self.config.head_size)  # (1, nh_av, aT, hs)
+        return ak, av
 
     def reset_parameters(self) -> None:
         if hasattr(self, "gating_factor"):
@@ -180,6 +216,12 @@ class CausalSelfAttention(BaseCausalSelfAttention):
         super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
 
+def _version_key(tensors: Iterable[Optional[torch.Tensor]]) -> Tuple:
+    """Identifies the memory and the in-place updates of `tensors`, for caches derived from them."""
+    # inference tensors do not track a version counter
+    return tuple((t.data_ptr(), None if t.is_inference() else t._version) for t in tensors if t is not None)
+
+
 def mark_only_adapter_as_trainable(model: GPT) -> None:
     """Sets `requires_grad=False` for all non-adapter weights."""
     for name, param in model.named_parameters():
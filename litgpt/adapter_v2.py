@@ -8,6 +8,7 @@ https://arxiv.org/abs/2304.15010
 Port for LitGPT
 """
 
+import re
 from dataclasses import dataclass
 from typing import Any, Dict, List, Optional, Tuple, Type, Union
 
@@ -20,7 +21,7 @@ from litgpt.adapter import GPT as BaseModel
 from litgpt.adapter import Block as BaseBlock
 from litgpt.adapter import CausalSelfAttention as BaseCausalSelfAttention
 from litgpt.adapter import Config as BaseConfig
-from litgpt.model import KVCache
+from litgpt.model import KVCache, LazyKVCache, do_softcapping
 from litgpt.scripts.convert_hf_checkpoint import qkv_reassemble
 from litgpt.utils import map_old_state_dict_weights
 
@@ -32,36 +33,105 @@ class Config(BaseConfig):
         return getattr(litgpt.adapter_v2, self.mlp_class_name)
 
 
+_ADAPTER_SUBSTRINGS = (
+    # regular adapter v1 parameters
+    "adapter_wte",
+    "gating_factor",
+    # adapter v2: new bias and scale used in Linear
+    "adapter_scale",
+    "adapter_bias",
+    # adapter v2: Norm parameters are now trainable
+    "norm_1",
+    "norm_2",
+    "ln_f",
+)
+# a single alternation matches all the substrings in one pass over the key
+_ADAPTER_PATTERN = re.compile("|".join(map(re.escape, _ADAPTER_SUBSTRINGS)))
+
+
 def adapter_filter(key: str, value: Any) -> bool:
-    adapter_substrings = (
-        # regular adapter v1 parameters
-        "adapter_wte",
-        "gating_factor",
-        # adapter v2: new bias and scale used in Linear
-        "adapter_scale",
-        "adapter_bias",
-        # adapter v2: Norm parameters are now trainable
-        "norm_1",
-        "norm_2",
-        "ln_f",
-    )
-    return any(s in key for s in adapter_substrings)
+    return _ADAPTER_PATTERN.search(key) is not None
 
 
 class AdapterV2Linear(torch.nn.Module):
     def __init__(self, in_features: int, out_features: int, **kwargs) -> None:
         super().__init__()
         self.linear = torch.nn.Linear(in_features, out_features, **kwargs)
-        self.adapter_bias = torch.nn.Parameter(torch.zeros(out_features), requires_grad=False)
-        self.adapter_scale = torch.nn.Parameter(torch.ones(out_features), requires_grad=False)
+        # created like the linear weights, so that `dtype` also applies to them
+        factory_kwargs = {"device": kwargs.get("device"), "dtype": kwargs.get("dtype")}
+        self.adapter_bias = torch.nn.Parameter(torch.zeros(out_features, **factory_kwargs), requires_grad=False)
+        self.adapter_scale = torch.nn.Parameter(torch.ones(out_features, **factory_kwargs), requires_grad=False)
+        # (adapter scale, adapter bias, linear bias) before `fuse()`
+        self._fused: Optional[Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]] = None
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        return self.adapter_scale * (self.linear(x) + self.adapter_bias)
+        if self._fused is not None:
+            # the fused bias lives in `adapter_bias`, so that the state dict keys stay the same
+            return torch.nn.functional.linear(x, self.linear.weight, self.adapter_bias)
+        y = self.linear(x)
+        # with mixed precision, `linear` runs in the autocast dtype. casting the (float32) adapter parameters keeps the
+        # pointwise ops and the output in that dtype instead of upcasting them. the gradients still flow in float32
+        scale, bias = self.adapter_scale.to(y.dtype), self.adapter_bias.to(y.dtype)
+        # same as `adapter_scale * (linear(x) + adapter_bias)` without materializing the intermediate sum
+        return torch.addcmul(scale * bias, y, scale)
+
+    def chunked(self, x: torch.Tensor, chunk_size: int) -> List[torch.Tensor]:
+        """Same as `[self(x_i) for x_i in x.split(chunk_size, dim=1)]`, like the chunked lm_head does.
+
+        The casted adapter scale and the scaled bias are computed once for all the chunks instead of once per chunk,
+        so that each chunk only runs the linear layer and a single `addcmul`.
+        """
+        chunks = x.split(chunk_size, dim=1)
+        if self._fused is not None:
+            return [self(x_i) for x_i in chunks]
+        y = self.linear(chunks[0])
+        scale, bias = self.adapter_scale.to(y.dtype), self.adapter_bias.to(y.dtype)
+        shift = scale * bias
+        return [torch.addcmul(shift, y, scale)] + [torch.addcmul(shift, self.linear(x_i), scale) for x_i in chunks[1:]]
+
+    @torch.no_grad()
+    def fuse(self) -> None:
+        """Bakes `adapter_scale` into the weights of `linear` and the biases into `adapter_bias`, in-place.
+
+        The linear bias is zeroed and `adapter_scale` is reset to one, so that the state dict keeps its keys and still
+        describes the same function. The forward pass becomes a single linear layer. Use `unfuse()` to restore them.
+        """
+        if self._fused is not None:
+            return
+        scale, bias = self.adapter_scale.clone(), self.adapter_bias.clone()
+        linear_bias = None if self.linear.bias is None else self.linear.bias.clone()
+        self.linear.weight.mul_(scale.unsqueeze(1))
+        if linear_bias is not None:
+            self.adapter_bias.add_(linear_bias)
+            nn.init.zeros_(self.linear.bias)
+        self.adapter_bias.mul_(scale)
+        nn.init.ones_(self.adapter_scale)
+        self._fused = (scale, bias, linear_bias)
+
+    @torch.no_grad()
+    def unfuse(self) -> None:
+        """Reverts `fuse()`. This is exact up to the floating point error of the division of the weights."""
+        if self._fused is None:
+            return
+        scale, bias, linear_bias = self._fused
+        if (scale == 0).any():
+            raise ValueError("Cannot unfuse an `adapter_scale` with zeros, since the fused weights were zeroed out")
+        self.linear.weight.div_(scale.unsqueeze(1))
+        if linear_bias is not None:
+            self.linear.bias.copy_(linear_bias)
+        self.adapter_scale.copy_(scale)
+        self.adapter_bias.copy_(bias)
+        self._fused = None
 
     def reset_parameters(self) -> None:
         nn.init.zeros_(self.adapter_bias)
         nn.init.ones_(self.adapter_scale)
 
+    def _load_from_state_dict(self, state_dict: Dict, prefix: str, *args: Any, **kwargs: Any) -> None:
+        # a partial state dict, such as an adapter-only checkpoint, is loaded on top of the unfused weights
+        self.unfuse()
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 
 class GPT(BaseModel):
     def __init__(self, config: Config) -> None:
@@ -78,22 +148,46 @@ class GPT(BaseModel):
                 ln_f=config.norm_class(config.n_embd, eps=config.norm_eps),
             )
         )
+        # (graph, static idx, static input_pos, static logits) set by `enable_cuda_graph_decode()`
+        self._cuda_graph: Optional[Tuple[torch.cuda.CUDAGraph, torch.Tensor, torch.Tensor, torch.Tensor]] = None
         self.max_seq_length = self.config.block_size
         self.mask_cache: Optional[torch.Tensor] = None
 
     def forward(
         self, idx: torch.Tensor, input_pos: Optional[torch.Tensor] = None, lm_head_chunk_size: int = 0
     ) -> Union[torch.Tensor, List[torch.Tensor]]:
+        # the graph was captured without autograd, so it would return detached logits
+        replay = input_pos is not None and not lm_head_chunk_size and not torch.is_grad_enabled()
+        if self._cuda_graph is not None and replay:
+            graph, static_idx, static_input_pos, static_logits = self._cuda_graph
+            if idx.shape == static_idx.shape and input_pos.shape == static_input_pos.shape:
+                static_idx.copy_(idx)
+                static_input_pos.copy_(input_pos)
+                graph.replay()
+                # the static output is overwritten by the next replay
+                return static_logits.clone()
+
         T = idx.size(1)
         if self.max_seq_length < T:
             raise ValueError(f"Cannot forward sequence of length {T}, max seq length is only {self.max_seq_length}.")
 
         if input_pos is not None:  # use the kv cache
-            cos = self.cos.index_select(0, input_pos)
-            sin = self.sin.index_select(0, input_pos)
             if self.mask_cache is None:
                 raise TypeError("You need to call `gpt.set_kv_cache()`")
-            mask = self.mask_cache.index_select(2, input_pos)
+            if input_pos.numel() == 1 and not torch._dynamo.is_compiling() and not self._is_capturing():
+                # single token decoding: slicing returns views instead of launching gather kernels. the compiled
+                # and CUDA graphs keep `index_select` since the `int()` call would bake the position into them
+                i = int(input_pos)
+                cos = self.cos[i : i + 1]
+                sin = self.sin[i : i + 1]
+                mask = self.mask_cache[:, :, i : i + 1]
+                if self.config.sliding_window_size is not None:
+                    # the sliding window attention updates the mask in-place
+                    mask = mask.clone()
+            else:
+                cos = self.cos.index_select(0, input_pos)
+                sin = self.sin.index_select(0, input_pos)
+                mask = self.mask_cache.index_select(2, input_pos)
         else:
             cos = self.cos[:T]
             sin = self.sin[:T]
@@ -107,16 +201,135 @@ class GPT(BaseModel):
         x = self.transformer.ln_f(x)
         if lm_head_chunk_size > 0:
             # chunk the lm head logits to reduce the peak memory used by autograd
-            return [self.lm_head(x_i) for x_i in x.split(lm_head_chunk_size, dim=1)]
+            return [self._softcapping(y) for y in self.lm_head.chunked(x, lm_head_chunk_size)]
         x = self.lm_head(x)  # (b, t, vocab_size)
-        if self.config.final_logit_softcapping is not None:
-            x = torch.tanh(x / self.config.final_logit_softcapping) * self.config.final_logit_softcapping
-        return x
+        return self._softcapping(x)
+
+    @staticmethod
+    def _is_capturing() -> bool:
+        return torch.cuda.is_available() and torch.cuda.is_current_stream_capturing()
+
+    def _softcapping(self, x: torch.Tensor) -> torch.Tensor:
+        if (thresh := self.config.final_logit_softcapping) is None:
+            return x
+        if x.requires_grad:
+            return do_softcapping(x, thresh)
+        # the logits aren't needed for backward, so we can avoid two allocations of the full logits tensor
+        return x.div_(thresh).tanh_().mul_(thresh)
 
     @classmethod
     def from_name(cls, name: str, **kwargs: Any) -> Self:
         return cls(Config.from_name(name, **kwargs))
 
+    def rope_cache(self, device: Optional[torch.device] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        # the new rope cache replaces the buffers that the captured graph reads
+        self._cuda_graph = None
+        cos, sin = super().rope_cache(device=device)
+        # every block reads the rope cache at each step. `apply_rope` casts its output to the activation dtype anyway,
+        # so keep the cache in the weights' (half) precision instead of float32 to halve these reads
+        dtype = self.transformer.wte.weight.dtype
+        if dtype in (torch.float16, torch.bfloat16):
+            cos, sin = cos.to(dtype), sin.to(dtype)
+        return cos, sin
+
+    def set_kv_cache(self, *args: Any, **kwargs: Any) -> None:
+        # the captured graph points to the previous kv cache buffers
+        self._cuda_graph = None
+        super().set_kv_cache(*args, **kwargs)
+
+    def clear_kv_cache(self) -> None:
+        self._cuda_graph = None
+        super().clear_kv_cache()
+
+    @torch.no_grad()
+    def enable_cuda_graph_decode(self, static_input_shape: Tuple[int, int] = (1, 1), warmup_steps: int = 3) -> None:
+        """Captures a single token decoding step in a CUDA graph, which `forward` replays for matching inputs.
+
+        All tensors have the same shape at every decoding step, so replaying the graph launches all of its kernels at
+        once instead of dispatching every operation from Python. Call it after `set_kv_cache()` and after loading the
+        weights, as the graph reads them from their current memory. Changing the kv cache, `max_seq_length`, the
+        fused adapter state, the loaded weights or the device drops the graph.
+
+        Args:
+            static_input_shape: The (batch size, sequence length) of the decoded `idx`. Only single token decoding
+                is supported.
+            warmup_steps: The number of eager steps run before the capture.
+        """
+        if self.mask_cache is None:
+            raise TypeError("You need to call `gpt.set_kv_cache()`")
+        if isinstance(self.transformer.h[0].attn.kv_cache, LazyKVCache):
+            raise NotImplementedError("The lazy KV cache grows its buffers from the host and cannot be captured.")
+        if (T := static_input_shape[1]) != 1:
+            raise ValueError(f"Only single token decoding can be captured, got a sequence length of {T}.")
+        device = self.transformer.wte.weight.device
+        if device.type != "cuda":
+            raise ValueError(f"CUDA graphs require the model to be on a CUDA device, got {device}.")
+        self._cuda_graph = None
+        static_idx = torch.zeros(static_input_shape, dtype=torch.int64, device=device)
+        # the warmup and capture write to the last kv cache position, which stays masked until it is decoded
+        static_input_pos = torch.tensor([self.mask_cache.size(-1) - 1], device=device)
+
+        # warm up on a side stream, as recommended by the CUDA graphs documentation
+        stream = torch.cuda.Stream(device)
+        stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(stream):
+            for _ in range(warmup_steps):
+                self(static_idx, static_input_pos)
+        torch.cuda.current_stream(device).wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_logits = self(static_idx, static_input_pos)
+        self._cuda_graph = (graph, static_idx, static_input_pos, static_logits)
+
+    def disable_cuda_graph_decode(self) -> None:
+        self._cuda_graph = None
+
+    def fuse_adapter_for_inference(self) -> None:
+        """Bakes the adapter scales and biases into the weights of every `AdapterV2Linear`, in-place.
+
+        This makes each of them a single linear layer without extra memory. Call it after loading the checkpoints.
+        Layers whose `linear` was replaced, for instance by quantization, are left untouched.
+        """
+        self._cuda_graph = None
+        for module in self.modules():
+            if isinstance(module, AdapterV2Linear) and type(module.linear) is torch.nn.Linear:
+                module.fuse()
+
+    def unfuse_adapter(self) -> None:
+        """Reverts `fuse_adapter_for_inference()`, for instance to continue training."""
+        self._cuda_graph = None
+        for module in self.modules():
+            if isinstance(module, AdapterV2Linear):
+                module.unfuse()
+
+    def compile_blocks(
+        self, mode: Optional[str] = "reduce-overhead", dynamic: bool = False, fullgraph: bool = True, **kwargs: Any
+    ) -> None:
+        """Compiles every `Block`, `ln_f` and `lm_head` separately with `torch.compile`.
+
+        This regional compilation is much faster to compile than the whole model since all blocks run the same code,
+        and any recompilation stays localized to the module whose inputs changed. The modules are compiled in-place,
+        so the state dict keys are unchanged.
+
+        Args:
+            mode: The `torch.compile` mode. "reduce-overhead" additionally captures CUDA graphs per input shape.
+            dynamic: Whether to compile with dynamic shapes. Chunking the logits with `lm_head_chunk_size` (and
+                varying sequence lengths) create new input shapes for `lm_head`, so setting this avoids a
+                recompilation per shape.
+            fullgraph: Whether each module must compile to a single graph. Set it to False for the models that need
+                host synchronizations: mixture of experts models, which count the tokens per expert, and the lazy
+                kv cache of `set_kv_cache(lazy=True)`, which reads the written length.
+            kwargs: Additional arguments passed on to `torch.compile`.
+        """
+        for module in (*self.transformer.h, self.transformer.ln_f, self.lm_head):
+            module.compile(mode=mode, fullgraph=fullgraph, dynamic=dynamic, **kwargs)
+
+    def _apply(self, fn: Any, *args: Any, **kwargs: Any) -> Self:
+        # moving or casting the model reallocates the tensors that the captured graph reads
+        self._cuda_graph = None
+        return super()._apply(fn, *args, **kwargs)
+
     def _init_weights(self, module: nn.Module) -> None:
         """Meant to be used with `gpt.apply(gpt._init_weights)`. Unused method left for completeness."""
         super()._init_weights(module)
@@ -125,6 +338,8 @@ class GPT(BaseModel):
 
     def _load_from_state_dict(self, state_dict: Dict, prefix: str, *args: Any, **kwargs: Any) -> None:
         """For compatibility with base checkpoints."""
+        # the loaded weights may change the fused state that the captured graph was recorded with
+        self._cuda_graph = None
         mapping = {"lm_head.weight": "lm_head.linear.weight", "lm_head.bias": "lm_head.linear.bias"}
         state_dict = map_old_state_dict_weights(state_dict, mapping, prefix)
         super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
@@ -178,6 +393,7 @@ class CausalSelfAttention(BaseCausalSelfAttention):
             self.gating_factor = torch.nn.Parameter(torch.zeros(1, 1, config.n_head, 1))
             # kv cache for inference
             self.adapter_kv_cache: Optional[Tuple[torch.Tensor, torch.Tensor]] = None
+            self.adapter_kv_cache_key: Optional[Tuple] = None
         self.block_idx = block_idx
         self.apply_sliding_window_attention = (
                 config.sliding_window_size is not None and
@@ -250,15 +466,31 @@ class LLaMAMLP(litgpt.model.LLaMAMLP):
         state_dict = map_old_state_dict_weights(state_dict, mapping, prefix)
         super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x_fc_1 = self.fc_1(x)
+        x_fc_2 = self.fc_2(x)
+        if _needs_grad(x_fc_1, x_fc_2):
+            x = torch.nn.functional.silu(x_fc_1) * x_fc_2
+        else:
+            # the intermediates aren't needed for backward, so compute the product in the fc_1 output
+            x = torch.nn.functional.silu(x_fc_1, inplace=True).mul_(x_fc_2)
+        return self.proj(x)
+
 
 class GemmaMLP(LLaMAMLP):
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x_fc_1 = self.fc_1(x)
         x_fc_2 = self.fc_2(x)
-        x = torch.nn.functional.gelu(x_fc_1, approximate=self.config.gelu_approximate) * x_fc_2
+        x = torch.nn.functional.gelu(x_fc_1, approximate=self.config.gelu_approximate)
+        # gelu has no in-place variant, but the product can still be written into its output
+        x = x * x_fc_2 if _needs_grad(x_fc_1, x_fc_2) else x.mul_(x_fc_2)
         return self.proj(x)
 
 
+def _needs_grad(*tensors: torch.Tensor) -> bool:
+    return any(t.requires_grad for t in tensors)
+
+
 class LLaMAMoE(litgpt.model.LLaMAMoE):
     def __init__(self, config: Config) -> None:
         nn.Module.__init__(self)
@@ -273,6 +505,33 @@ class LLaMAMoE(litgpt.model.LLaMAMoE):
         state_dict = map_old_state_dict_weights(state_dict, mapping, prefix)
         super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """Same as `litgpt.model.LLaMAMoE.forward`, with the tokens grouped by expert.
+
+        Each expert runs once on a contiguous slice of the sorted tokens, and the outputs are scattered back with a
+        single `index_add_`. This needs one device synchronization for the token counts instead of a `torch.where`
+        per expert, and experts without tokens are skipped. The expert weights are not stacked, which would duplicate
+        them.
+        """
+        B, T, C = x.size()  # batch size, sequence length, embedding dimensionality (n_embd)
+        x = x.view(-1, C)  # (B*T, C)
+        router = self.gate(x)  # (B*T, n_expert)
+        probs, indices = torch.topk(router, self.config.n_expert_per_token)  # (B*T, n_expert_per_token)
+        probs = probs.softmax(dim=1, dtype=torch.float).to(dtype=x.dtype)
+        indices = indices.flatten()  # (B*T*n_expert_per_token)
+        order = indices.argsort(stable=True)
+        token_idx = order // self.config.n_expert_per_token
+        counts = torch.bincount(indices, minlength=self.config.n_expert).tolist()
+        outputs = [
+            expert(x_expert)
+            for expert, x_expert, count in zip(self.experts, x[token_idx].split(counts), counts)
+            if count
+        ]
+        # without tokens, there are no expert outputs to concatenate
+        y = torch.cat(outputs) if outputs else x[:0]
+        y = y * probs.flatten()[order, None]
+        return torch.zeros_like(x).index_add_(0, token_idx, y).view(B, T, C)
+
 
 def mark_only_adapter_v2_as_trainable(model: GPT) -> None:
     """Sets requires_grad=False for all non-adapter weights"""
@@ -126,6 +126,7 @@ def main(
     adapter_checkpoint = lazy_load(adapter_path)
     checkpoint.update(adapter_checkpoint.get("model", adapter_checkpoint))
     model.load_state_dict(checkpoint)
+    model.fuse_adapter_for_inference()
     fabric.print(f"Time to load the model weights: {time.perf_counter() - t0:.02f} seconds.", file=sys.stderr)
 
     model = fabric.setup(model)
@@ -175,13 +175,30 @@ class GPT(nn.Module):
         rope_cache_length: Optional[int] = None,
         device: Optional[torch.device] = None,
         dtype: Optional[torch.dtype] = None,
+        lazy: bool = False,
     ) -> None:
+        """Enables the KV cache, which is needed to pass `input_pos` to `forward` for incremental decoding.
+
+        Prefill-only uses such as evaluation or embedding extraction should call `forward` without `input_pos`
+        instead, which uses causal attention without allocating a cache or a mask.
+
+        Args:
+            batch_size: The batch size of the decoded sequences.
+            max_seq_length: The number of positions to cache. Defaults to `max_seq_length`.
+            rope_cache_length: The size of the rope cache's last dimension. Defaults to that of `cos`.
+            device: The device of the cache.
+            dtype: The data type of the cache.
+            lazy: Whether to use a `LazyKVCache`, which grows as positions get written instead of reserving
+                `max_seq_length` positions upfront.
+        """
         if rope_cache_length is None:
             rope_cache_length = self.cos.size(-1)
 
         if max_seq_length is None:
             max_seq_length = self.max_seq_length
 
+        # the lazy caches of all blocks share the length of the written positions
+        written_length = _WrittenLength() if lazy else None
         # initialize the kv cache for all blocks
         for block in self.transformer.h:
             block.attn.kv_cache = block.attn.build_kv_cache(
@@ -190,6 +207,7 @@ class GPT(nn.Module):
                 rope_cache_length,
                 device,
                 dtype,
+                written_length,
             )
 
         if self.mask_cache is None or self.mask_cache.size(3) != max_seq_length:
@@ -342,6 +360,9 @@ class CausalSelfAttention(nn.Module):
             if not isinstance(self.kv_cache, KVCache):
                 raise TypeError("You need to call `gpt.set_kv_cache()`")
             k, v = self.kv_cache(input_pos, k, v)
+            if mask is not None and mask.size(-1) != k.size(-2):
+                # the lazy kv cache only returns the positions that have been written
+                mask = mask[..., : k.size(-2)]
 
         # Grouped queries: balance the number of heads across all three matrices.
         # NOTE: flash attention requires it in training mode.
@@ -408,6 +429,7 @@ class CausalSelfAttention(nn.Module):
         rope_cache_length: Optional[int] = None,
         device: Optional[torch.device] = None,
         dtype: Optional[torch.dtype] = None,
+        written_length: Optional["_WrittenLength"] = None,
     ) -> "KVCache":
         v_shape = (batch_size, self.config.n_query_groups, max_seq_length, self.config.head_size)
         if rope_cache_length is None:
@@ -421,6 +443,8 @@ class CausalSelfAttention(nn.Module):
                 max_seq_length,
                 rope_cache_length + self.config.head_size - self.config.rope_n_elem,
             )
+        if written_length is not None:
+            return LazyKVCache(k_shape, v_shape, device=device, dtype=dtype, written_length=written_length)
         return KVCache(k_shape, v_shape, device=device, dtype=dtype)
 
     def _load_from_state_dict(self, state_dict: Dict, prefix: str, *args: Any, **kwargs: Any) -> None:
@@ -668,6 +692,84 @@ class KVCache(nn.Module):
         torch.nn.init.zeros_(self.v)
 
 
+class LazyKVCache(KVCache):
+    """A KV cache that grows its buffers as positions get written instead of reserving `max_seq_length` upfront.
+
+    The buffers double their size when they overflow, so the number of reallocations is logarithmic in the sequence
+    length. The returned keys and values are views of the positions written so far.
+    """
+
+    def __init__(
+        self,
+        k_shape: Tuple[int, int, int, int],
+        v_shape: Tuple[int, int, int, int],
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+        written_length: Optional["_WrittenLength"] = None,
+    ) -> None:
+        # Skip the parent class __init__ altogether and replace it to avoid the upfront allocation
+        nn.Module.__init__(self)
+        self.max_seq_length = k_shape[2]
+        k_shape = (k_shape[0], k_shape[1], 0, k_shape[3])
+        v_shape = (v_shape[0], v_shape[1], 0, v_shape[3])
+        self.register_buffer("k", torch.zeros(k_shape, device=device, dtype=dtype), persistent=False)
+        self.register_buffer("v", torch.zeros(v_shape, device=device, dtype=dtype), persistent=False)
+        # reading the written length synchronizes with the device, so the caches of all layers share it. the first
+        # cache reads it in every forward pass and the caches of the following layers reuse it
+        self.written_length = _WrittenLength() if written_length is None else written_length
+        self.updates_length = self.written_length.n_caches == 0
+        self.written_length.n_caches += 1
+
+    def forward(self, input_pos: torch.Tensor, k: torch.Tensor, v: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self.updates_length:
+            self.written_length.update(input_pos)
+        length = self.written_length.length
+        # move the buffer to the activation dtype for when AMP is used
+        self.k = self._grow(self.k.to(k.dtype), length)
+        self.v = self._grow(self.v.to(v.dtype), length)
+        # update the cache
+        n = k.size(0)
+        k = batched_index_copy_(self.k[:n, :, :length], -2, input_pos, k)
+        v = batched_index_copy_(self.v[:n, :, :length], -2, input_pos, v)
+        return k, v
+
+    def _grow(self, buffer: torch.Tensor, length: int) -> torch.Tensor:
+        capacity = buffer.size(2)
+        if length <= capacity:
+            return buffer
+        if length > self.max_seq_length:
+            raise IndexError(f"Cannot write position {length - 1}, the kv cache size is only {self.max_seq_length}.")
+        # double the capacity to amortize the reallocations
+        capacity = min(max(length, 2 * capacity), self.max_seq_length)
+        new_buffer = buffer.new_zeros(*buffer.shape[:2], capacity, buffer.size(3))
+        new_buffer[:, :, : buffer.size(2)] = buffer
+        return new_buffer
+
+    def reset_parameters(self) -> None:
+        # release the buffers
+        self.k = self.k.new_zeros(*self.k.shape[:2], 0, self.k.size(3))
+        self.v = self.v.new_zeros(*self.v.shape[:2], 0, self.v.size(3))
+        self.written_length.reset()
+
+
+class _WrittenLength:
+    """Tracks the number of positions written to the lazy kv caches of a model.
+
+    The maximum of `input_pos` is read once per forward pass, by the cache of the first layer, and then reused by the
+    caches of all the following layers. The decoding loops update `input_pos` in-place, so it is read every time.
+    """
+
+    def __init__(self) -> None:
+        self.n_caches = 0
+        self.reset()
+
+    def update(self, input_pos: torch.Tensor) -> None:
+        self.length = max(self.length, int(input_pos.max()) + 1)
+
+    def reset(self) -> None:
+        self.length = 0
+
+
 def build_mask_cache(max_seq_length: int, device: Optional[torch.device] = None) -> torch.Tensor:
     ones = torch.ones((max_seq_length, max_seq_length), device=device, dtype=torch.bool)
     return torch.tril(ones).unsqueeze(0).unsqueeze(0)
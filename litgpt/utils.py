@@ -344,6 +344,7 @@ def chunked_cross_entropy(
 
 
 def map_old_state_dict_weights(state_dict: Dict, mapping: Mapping, prefix: str) -> Dict:
+    """Renames the `mapping` keys under `prefix` in-place, without copying the dict or its tensors, and returns it."""
     for checkpoint_name, attribute_name in mapping.items():
         full_checkpoint_name = prefix + checkpoint_name
         if full_checkpoint_name in state_dict:
@@ -118,6 +118,48 @@ def test_adapter_gpt_init_weights():
     assert (param == 0).all()
 
 
+@torch.inference_mode()
+@pytest.mark.parametrize("n_query_groups", (1, 2, 4))
+def test_adapter_prefix_attention(n_query_groups):
+    config = Config(n_layer=1, n_head=4, n_query_groups=n_query_groups, n_embd=16, block_size=8, adapter_start_layer=0)
+    attn = CausalSelfAttention(config, block_idx=0)
+    torch.nn.init.normal_(attn.gating_factor)
+    q = torch.randn(2, 4, 8, 4)
+    k, v = torch.randn(2, 2, 4, 8, 4).unbind(0)
+    y = attn.scaled_dot_product_attention(q, k, v)
+
+    ak, av = attn.adapter_kv_cache
+    # multi-query attention relies on broadcasting
+    assert ak.shape == av.shape == (1, 1 if n_query_groups == 1 else 4, 10, 4)
+    scores = (q @ ak.mT / 2).softmax(dim=-1)
+    expected = gpt.CausalSelfAttention.scaled_dot_product_attention(attn, q, k, v)
+    expected = expected + attn.gating_factor * (scores @ av).transpose(1, 2)
+    torch.testing.assert_close(y, expected)
+
+
+def test_adapter_kv_cache():
+    model = GPT.from_name("pythia-14m", n_layer=2, adapter_start_layer=1)
+    attn = model.transformer.h[1].attn
+    x = torch.randint(model.config.vocab_size, size=(1, 4), dtype=torch.int64)
+
+    # training steps don't cache the prompt keys and values, which would be detached from the next step's graph
+    for _ in range(2):
+        model(x).sum().backward()
+        assert attn.adapter_kv_cache is None
+
+    model.prepare_adapter_cache()
+    assert not hasattr(model.transformer.h[0].attn, "adapter_kv_cache")
+    ak, av = attn.adapter_kv_cache
+    with torch.no_grad():
+        expected = model(x)
+        assert attn.adapter_kv()[0] is ak
+        # in-place updates invalidate the cache
+        attn.adapter_wte.weight.add_(1)
+        assert attn.adapter_kv()[0] is not ak
+        attn.adapter_wte.weight.sub_(1)
+        torch.testing.assert_close(model(x), expected)
+
+
 @RunIf(dynamo=True)
 @torch.inference_mode()
 def test_adapter_compile():
@@ -17,10 +17,11 @@ from transformers.models.gemma import GemmaConfig, GemmaForCausalLM
 from transformers.models.gemma2 import Gemma2Config, Gemma2ForCausalLM
 from transformers.models.mixtral import MixtralConfig, MixtralForCausalLM
 
+import litgpt
 import litgpt.config as config_module
 import litgpt.finetune.adapter_v2 as module
 from litgpt.adapter_v2 import GPT as AdapterV2GPT
-from litgpt.adapter_v2 import CausalSelfAttention, Config, adapter_filter
+from litgpt.adapter_v2 import AdapterV2Linear, CausalSelfAttention, Config, GemmaMLP, LLaMAMLP, LLaMAMoE, adapter_filter
 from litgpt.args import EvalArgs, TrainArgs
 from litgpt.data import Alpaca
 from litgpt.model import GPT as BaseGPT
@@ -135,6 +136,248 @@ def test_adapter_v2_gpt_init_weights():
         assert (param == 0).all()
 
 
+def test_adapter_v2_linear_dtype():
+    layer = AdapterV2Linear(8, 4, dtype=torch.bfloat16)
+    assert layer.adapter_bias.dtype == layer.adapter_scale.dtype == torch.bfloat16
+
+    # with mixed precision, the output stays in the autocast dtype while the parameters get float32 gradients
+    layer = AdapterV2Linear(8, 4)
+    layer.adapter_scale.requires_grad_(True)
+    x = torch.randn(2, 3, 8)
+    with torch.autocast("cpu", dtype=torch.bfloat16):
+        y = layer(x)
+    assert y.dtype == torch.bfloat16
+    y.float().sum().backward()
+    assert layer.adapter_scale.grad.dtype == torch.float32
+
+
+@pytest.mark.parametrize("bias", (True, False))
+def test_adapter_v2_linear_forward(bias):
+    layer = AdapterV2Linear(8, 4, bias=bias)
+    torch.nn.init.normal_(layer.adapter_bias)
+    torch.nn.init.normal_(layer.adapter_scale)
+    x = torch.randn(2, 3, 8)
+    expected = layer.adapter_scale * (layer.linear(x) + layer.adapter_bias)
+
+    with torch.no_grad():
+        torch.testing.assert_close(layer(x), expected)
+    # no copy of the weights is kept around
+    assert not any(isinstance(v, (torch.Tensor, tuple)) for v in vars(layer).values() if v is not None)
+
+    layer.adapter_scale.requires_grad_(True)
+    y = layer(x)
+    torch.testing.assert_close(y, expected)
+    y.sum().backward()
+    assert layer.adapter_scale.grad is not None
+
+
+@pytest.mark.parametrize("fused", (False, True))
+def test_adapter_v2_linear_chunked(fused):
+    layer = AdapterV2Linear(8, 4)
+    torch.nn.init.normal_(layer.adapter_bias)
+    torch.nn.init.normal_(layer.adapter_scale)
+    if fused:
+        layer.fuse()
+    else:
+        layer.adapter_scale.requires_grad_(True)
+    x = torch.randn(2, 10, 8)
+
+    chunks = layer.chunked(x, 4)
+    assert [c.size(1) for c in chunks] == [4, 4, 2]
+    torch.testing.assert_close(torch.cat(chunks, dim=1), layer(x))
+    if not fused:
+        (grad,) = torch.autograd.grad(torch.cat(chunks, dim=1).sum(), layer.adapter_scale)
+        (expected,) = torch.autograd.grad(layer(x).sum(), layer.adapter_scale)
+        torch.testing.assert_close(grad, expected)
+
+
+@torch.inference_mode()
+def test_adapter_v2_fuse_adapter_for_inference():
+    # pythia's linear layers have biases, except for the lm_head
+    model = AdapterV2GPT.from_name("pythia-14m", n_layer=2)
+    for layer in model.modules():
+        if isinstance(layer, AdapterV2Linear):
+            torch.nn.init.normal_(layer.adapter_bias)
+            torch.nn.init.uniform_(layer.adapter_scale, 0.5, 1.5)
+    x = torch.randint(model.config.vocab_size, size=(2, 8), dtype=torch.int64)
+    expected = model(x)
+    state_dict = {k: v.clone() for k, v in model.state_dict().items()}
+
+    model.fuse_adapter_for_inference()
+    assert (model.lm_head.adapter_scale == 1).all()
+    assert model.lm_head.linear.bias is None
+    assert (model.transformer.h[0].attn.qkv.linear.bias == 0).all()
+    torch.testing.assert_close(model(x), expected)
+    # a fused state dict has the same keys and describes the same model
+    fused_state_dict = model.state_dict()
+    assert fused_state_dict.keys() == state_dict.keys()
+    other = AdapterV2GPT(model.config)
+    other.load_state_dict(fused_state_dict)
+    torch.testing.assert_close(other(x), expected)
+    # the original checkpoint loads into a fused model, which then no longer needs to be unfused
+    other = AdapterV2GPT(model.config)
+    other.fuse_adapter_for_inference()
+    other.load_state_dict(state_dict)
+    torch.testing.assert_close(other(x), expected)
+    other.unfuse_adapter()
+    torch.testing.assert_close(other(x), expected)
+    # an adapter-only checkpoint loads on top of the unfused base weights
+    other = AdapterV2GPT(model.config)
+    other.load_state_dict({k: v for k, v in state_dict.items() if not adapter_filter(k, v)}, strict=False)
+    other.fuse_adapter_for_inference()
+    other.load_state_dict({k: v for k, v in state_dict.items() if adapter_filter(k, v)}, strict=False)
+    torch.testing.assert_close(other(x), expected)
+    other.fuse_adapter_for_inference()
+    torch.testing.assert_close(other(x), expected)
+
+    model.unfuse_adapter()
+    assert model.lm_head.linear.bias is None
+    assert model.state_dict().keys() == state_dict.keys()
+    for k, v in model.state_dict().items():
+        torch.testing.assert_close(v, state_dict[k])
+
+
+@pytest.mark.parametrize("grad", (True, False))
+@pytest.mark.parametrize("name", ("pythia-14m", "gemma-2-9b"))
+def test_adapter_v2_chunked_lm_head(name, grad):
+    # Gemma 2 uses final logit softcapping
+    model = AdapterV2GPT.from_name(name, n_layer=1, n_head=2, n_query_groups=2, n_embd=16, intermediate_size=32)
+    torch.nn.init.normal_(model.lm_head.adapter_scale)
+    x = torch.randint(model.config.vocab_size, size=(2, 10), dtype=torch.int64)
+
+    with torch.set_grad_enabled(grad):
+        expected = model(x)
+        chunks = model(x, lm_head_chunk_size=4)
+    assert [c.size(1) for c in chunks] == [4, 4, 2]
+    torch.testing.assert_close(torch.cat(chunks, dim=1), expected)
+
+
+@torch.inference_mode()
+@pytest.mark.parametrize("name", ("pythia-14m", "Mistral-7B-v0.1"))
+def test_adapter_v2_single_token_decoding(name):
+    # Mistral uses sliding window attention, which updates the mask in-place
+    model = AdapterV2GPT.from_name(name, n_layer=2, n_head=4, n_query_groups=2, n_embd=16, block_size=8)
+    x = torch.randint(model.config.vocab_size, size=(1, 8), dtype=torch.int64)
+    expected = model(x)
+
+    model.set_kv_cache(batch_size=1)
+    mask_cache = model.mask_cache.clone()
+    model(x[:, :5], torch.arange(5))
+    for i in range(5, 8):
+        y = model(x[:, i : i + 1], torch.tensor([i]))
+        torch.testing.assert_close(y[:, 0], expected[:, i])
+    torch.testing.assert_close(model.mask_cache, mask_cache)
+
+
+def test_adapter_v2_cuda_graph_decode_errors():
+    model = AdapterV2GPT.from_name("pythia-14m", n_layer=1)
+    with pytest.raises(TypeError, match="set_kv_cache"):
+        model.enable_cuda_graph_decode()
+    model.set_kv_cache(batch_size=1)
+    with pytest.raises(ValueError, match="single token"):
+        model.enable_cuda_graph_decode((1, 2))
+    with pytest.raises(ValueError, match="CUDA device"):
+        model.enable_cuda_graph_decode()
+
+
+@pytest.mark.parametrize(
+    "invalidate",
+    (
+        lambda model: setattr(model, "max_seq_length", 8),
+        lambda model: model.fuse_adapter_for_inference(),
+        lambda model: model.unfuse_adapter(),
+        lambda model: model.load_state_dict(model.state_dict()),
+        lambda model: model.to(torch.float64),
+        lambda model: model.clear_kv_cache(),
+    ),
+)
+def test_adapter_v2_cuda_graph_decode_invalidation(invalidate):
+    model = AdapterV2GPT.from_name("pythia-14m", n_layer=1, block_size=16)
+    model.set_kv_cache(batch_size=1)
+    # stands in for a captured graph, which requires a CUDA device
+    model._cuda_graph = object()
+    invalidate(model)
+    assert model._cuda_graph is None
+
+
+def test_adapter_v2_cuda_graph_decode_skipped_with_grad():
+    class Graph:
+        def replay(self):
+            raise AssertionError("replayed")
+
+    model = AdapterV2GPT.from_name("pythia-14m", n_layer=1, block_size=16)
+    model.set_kv_cache(batch_size=1)
+    idx, input_pos = torch.zeros(1, 1, dtype=torch.int64), torch.tensor([0])
+    model._cuda_graph = (Graph(), idx.clone(), input_pos.clone(), torch.empty(0))
+    y = model(idx, input_pos)
+    assert y.requires_grad
+    with torch.no_grad(), pytest.raises(AssertionError, match="replayed"):
+        model(idx, input_pos)
+
+
+@RunIf(min_cuda_gpus=1)
+@torch.inference_mode()
+def test_adapter_v2_cuda_graph_decode():
+    with torch.device("cuda"):
+        model = AdapterV2GPT.from_name("pythia-14m", n_layer=2, block_size=8)
+        x = torch.randint(model.config.vocab_size, size=(1, 8), dtype=torch.int64)
+        expected = model(x)
+
+        model.set_kv_cache(batch_size=1)
+        model.enable_cuda_graph_decode()
+        model(x[:, :5], torch.arange(5))
+        for i in range(5, 8):
+            y = model(x[:, i : i + 1], torch.tensor([i]))
+            torch.testing.assert_close(y[:, 0], expected[:, i])
+
+    model.clear_kv_cache()
+    assert model._cuda_graph is None
+
+
+@pytest.mark.parametrize("mlp_class", (LLaMAMLP, GemmaMLP))
+def test_adapter_v2_mlp_inplace_activation(mlp_class):
+    config = Config(n_embd=16, n_head=2, intermediate_size=32, gelu_approximate="tanh")
+    mlp = mlp_class(config)
+    x = torch.randn(2, 4, 16, requires_grad=True)
+
+    expected = mlp(x)
+    expected.sum().backward()
+    assert x.grad is not None
+    with torch.no_grad():
+        torch.testing.assert_close(mlp(x), expected)
+
+
+@pytest.mark.parametrize("T", (0, 1, 8))
+def test_adapter_v2_moe_grouped_experts(T):
+    # with a single token, only 2 of the 4 experts receive tokens. without tokens, none of them do
+    config = Config(n_embd=16, n_head=2, intermediate_size=32, n_expert=4, n_expert_per_token=2)
+    moe = LLaMAMoE(config)
+    x = torch.randn(1, T, 16, requires_grad=True)
+    x_ref = x.detach().clone().requires_grad_(True)
+
+    y = moe(x)
+    expected = litgpt.model.LLaMAMoE.forward(moe, x_ref)
+    torch.testing.assert_close(y, expected)
+    y.sum().backward()
+    expected.sum().backward()
+    torch.testing.assert_close(x.grad, x_ref.grad)
+
+
+@pytest.mark.parametrize("dtype", (torch.float32, torch.bfloat16))
+def test_adapter_v2_rope_cache_dtype(dtype):
+    with torch.device("meta"):
+        model = AdapterV2GPT.from_name("pythia-14m", n_layer=1).to(dtype)
+    assert model.cos.dtype == model.sin.dtype == dtype
+    # the cache is rebuilt in the weights' dtype
+    model.max_seq_length = 8
+    assert model.cos.shape == (8, model.config.rope_n_elem)
+    assert model.cos.dtype == model.sin.dtype == dtype
+
+    model = AdapterV2GPT.from_name("pythia-14m", n_layer=1).to(dtype)
+    x = torch.randint(model.config.vocab_size, size=(1, 4), dtype=torch.int64)
+    assert model(x).dtype == dtype
+
+
 @pytest.mark.parametrize("name", [c["name"] for c in config_module.configs])
 def test_base_model_can_be_adapter_v2_loaded(name):
     kwargs = {"n_layer": 2, "n_head": 8, "n_query_groups": 4, "n_embd": 16, "padded_vocab_size": 32}
@@ -167,6 +410,33 @@ def test_adapter_v2_compile():
     assert explanation.graph_break_count == 0
 
 
+@RunIf(dynamo=True)
+@torch.inference_mode()
+def test_adapter_v2_compile_blocks():
+    model = AdapterV2GPT.from_name("pythia-14m", n_layer=2)
+    x = torch.randint(model.config.vocab_size, size=(2, 8), dtype=torch.int64)
+    expected = model(x)
+    state_dict_keys = set(model.state_dict())
+
+    model.compile_blocks(mode=None, backend="eager")
+    assert set(model.state_dict()) == state_dict_keys
+    torch.testing.assert_close(model(x), expected)
+
+
+@RunIf(dynamo=True)
+@torch.inference_mode()
+def test_adapter_v2_compile_blocks_moe():
+    # the mixture of experts counts the tokens per expert on the host, which cannot be captured in a single graph
+    model = AdapterV2GPT.from_name(
+        "Mixtral-8x7B-v0.1", n_layer=1, n_head=2, n_query_groups=2, n_embd=16, intermediate_size=32, n_expert=4
+    )
+    x = torch.randint(model.config.vocab_size, size=(2, 8), dtype=torch.int64)
+    expected = model(x)
+
+    model.compile_blocks(mode=None, fullgraph=False, backend="eager")
+    torch.testing.assert_close(model(x), expected)
+
+
 @torch.inference_mode()
 def test_against_hf_mixtral():
     device = torch.device("cpu")
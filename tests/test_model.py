@@ -32,7 +32,8 @@ from transformers.models.qwen2 import Qwen2Config, Qwen2ForCausalLM
 
 import litgpt.config as config_module
 from litgpt import GPT, Config
-from litgpt.model import CausalSelfAttention, batched_index_copy_
+from litgpt.generate.base import generate
+from litgpt.model import CausalSelfAttention, LazyKVCache, batched_index_copy_
 from litgpt.scripts.convert_hf_checkpoint import (
     copy_weights_falcon,
     copy_weights_gemma_2,
@@ -1090,6 +1091,54 @@ def test_kv_cache(max_seq_length):
         input_pos = input_pos[-1:] + 1
 
 
+@torch.inference_mode()
+def test_lazy_kv_cache():
+    config = Config(block_size=25, padded_vocab_size=5, n_layer=2, n_head=4, n_query_groups=2, n_embd=16)
+    model = GPT(config)
+    idx = torch.randint(0, model.config.padded_vocab_size, (2, 25))
+    model.set_kv_cache(2)
+    expected = [model(idx[:, :6], torch.arange(6))]
+    expected += [model(idx[:, i : i + 1], torch.tensor([i])) for i in range(6, 25)]
+
+    model.set_kv_cache(2, lazy=True)
+    kv_cache = model.transformer.h[0].attn.kv_cache
+    assert isinstance(kv_cache, LazyKVCache)
+    assert kv_cache.k.size(2) == 0
+    # all the layers share the written length
+    assert model.transformer.h[1].attn.kv_cache.written_length is kv_cache.written_length
+    torch.testing.assert_close(model(idx[:, :6], torch.arange(6)), expected[0])
+    assert kv_cache.k.size(2) == 6
+    capacities = []
+    for i in range(6, 25):
+        torch.testing.assert_close(model(idx[:, i : i + 1], torch.tensor([i])), expected[i - 5])
+        capacities.append(kv_cache.k.size(2))
+    # the capacity doubles, up to the cache size
+    assert sorted(set(capacities)) == [12, 24, 25]
+
+    k, _ = kv_cache(torch.tensor([3]), kv_cache.k[:, :, :1].clone(), kv_cache.v[:, :, :1].clone())
+    # the returned keys are a view of the written positions
+    assert k.size(2) == 25
+    assert k.untyped_storage().data_ptr() == kv_cache.k.untyped_storage().data_ptr()
+
+    kv_cache.reset_parameters()
+    assert kv_cache.k.size(2) == 0
+
+
+@torch.inference_mode()
+def test_lazy_kv_cache_generate():
+    config = Config(block_size=64, padded_vocab_size=5, n_layer=2, n_head=4, n_query_groups=2, n_embd=16)
+    model = GPT(config)
+    prompt = torch.randint(0, model.config.padded_vocab_size, (4,))
+    model.set_kv_cache(1)
+    expected = generate(model, prompt, 20, top_k=1)
+
+    # `generate` updates `input_pos` in-place at every decoding step
+    model.set_kv_cache(1, lazy=True)
+    torch.testing.assert_close(generate(model, prompt, 20, top_k=1), expected)
+    # the 20 written positions only grew the buffers to half of the cache size
+    assert model.transformer.h[1].attn.kv_cache.k.size(2) == 32
+
+
 @torch.inference_mode()
 def test_model_kv_cache_amp():
     config = Config.from_name("pythia-14m", n_layer=2)
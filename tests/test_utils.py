@@ -39,6 +39,7 @@ from litgpt.utils import (
     init_out_dir,
     instantiate_bnb_optimizer,
     instantiate_torch_optimizer,
+    map_old_state_dict_weights,
     num_parameters,
     parse_devices,
     save_hyperparameters,
@@ -190,6 +191,16 @@ def test_num_parameters_bitsandbytes(mode):
     assert num_parameters(model) == 14067712
 
 
+def test_map_old_state_dict_weights():
+    weight, bias = torch.zeros(2), torch.ones(2)
+    state_dict = {"h.0.fc.weight": weight, "h.0.fc.bias": bias, "h.1.fc.weight": weight}
+    mapping = {"fc.weight": "fc.linear.weight", "fc.bias": "fc.linear.bias", "fc.missing": "fc.linear.missing"}
+    # the keys are renamed in-place, the tensors are not copied
+    assert map_old_state_dict_weights(state_dict, mapping, "h.0.") is state_dict
+    assert state_dict == {"h.1.fc.weight": weight, "h.0.fc.linear.weight": weight, "h.0.fc.linear.bias": bias}
+    assert state_dict["h.0.fc.linear.weight"] is weight
+
+
 def test_cycle_iterator():
     iterator = CycleIterator([])
     with pytest.raises(StopIteration):